@@ -1,8 +1,10 @@
 import argparse
+import os
 import torch
 import yaml
 
-from models.translation_models import AlignAndTranslate
+from global_variables import AMP_DTYPE
+from models.translation_models import AlignAndTranslate, InferenceModel
 from src.data_preprocessing import load_data
 
 
@@ -74,6 +76,18 @@ if __name__ == "__main__":
         default=False,
         help="Ignore the config file",
     )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        default=False,
+        help="Compile the encoder and decoder with torch.compile",
+    )
+    parser.add_argument(
+        "--cuda_graph",
+        action="store_true",
+        default=False,
+        help="Replay the decoder steps of inference from captured CUDA graphs",
+    )
     parser.add_argument(
         "--test",
         action="store_true",
@@ -83,7 +97,17 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
     device = "cpu" if not torch.cuda.is_available() else "cuda"
-    print(f"Using {device} device")
+    # Launched with torchrun --nproc_per_node=N run.py: one process per GPU
+    distributed = "LOCAL_RANK" in os.environ
+    if distributed:
+        local_rank = int(os.environ["LOCAL_RANK"])
+        torch.distributed.init_process_group(
+            "nccl" if torch.cuda.is_available() else "gloo"
+        )
+        if torch.cuda.is_available():
+            torch.cuda.set_device(local_rank)
+            device = f"cuda:{local_rank}"
+    print(f"Using {device} device with {AMP_DTYPE} mixed precision")
     # Load YAML config file
     with open(args.config_file, "r") as config_file:
         config = yaml.safe_load(config_file)
@@ -109,6 +133,7 @@ if __name__ == "__main__":
         batch_size=config["batch_size"],
         vocab_source=config["vocab_source"],
         mp=config["multiprocessing"],
+        distributed=distributed,
     )
 
     # Define configuration for the decoder
@@ -159,6 +184,7 @@ if __name__ == "__main__":
         vocab_size=len(english_vocab) + 2,
         rnn_type="LSTM",
         embedding_size=config["embedding_size"],
+        compile=config["compile"],
     )
 
     # Define training configuration
@@ -172,6 +198,9 @@ if __name__ == "__main__":
         beam_search=True,
         Tx=config["Tx"],
         Ty=config["Ty"],
+        compile=config["compile"],
+        # torch.compile(mode="reduce-overhead") already records CUDA graphs
+        cuda_graph=config["cuda_graph"] and not config["compile"],
     )
 
     # Define translator configuration
@@ -180,6 +209,7 @@ if __name__ == "__main__":
     )
 
     # Create the model
+    # the encoder and the decoder compile themselves from their configs
     model = AlignAndTranslate(**translator_cfg).to(device)
     english_phrases = [
         "it should be noted that the marine environment is the least known of environments .",
@@ -194,7 +224,7 @@ if __name__ == "__main__":
         to_translate.append(dict(translation=dict(en=en, fr=fr)))
 
     sample, alignment = model.translate_sentence(to_translate)
-    for i, s in enumerate(sample):
+    for i, s in enumerate(sample if model.is_main_process else []):
         print(f"Sample {i+1}")
         en = s[0]
         fr = s[1]
@@ -203,7 +233,33 @@ if __name__ == "__main__":
 
     # Train the model
     if args.test:
-        evaluation = model.eval(val_dataloader, max_len=args.Ty)
+        # The float32 ONNX file (inputs x and lengths) is only written for
+        # serving the model outside of this script, it is not read back below
+        model.export_onnx(model.output_dir / "model.onnx", batch_size=config["batch_size"])
+        inference_model = None
+        try:
+            import torch_tensorrt  # noqa: F401
+
+            # TensorRT compiles the PyTorch module directly, it takes the same
+            # lengths as the eager evaluation. The hand-written CUDA graphs cannot
+            # be compiled
+            model.cuda_graph = False
+            inference_model = torch.compile(
+                InferenceModel(model),
+                backend="tensorrt",
+                dynamic=False,
+                options={"enabled_precisions": {torch.float32, AMP_DTYPE}},
+            )
+        except ImportError:
+            print("torch_tensorrt is not installed, evaluating with PyTorch")
+        evaluation = model.eval(
+            val_dataloader, max_len=args.Ty, inference_model=inference_model
+        )
         breakpoint()
     else:
+        if distributed:
+            model.distribute()
         model.train(train_loader=train_dataloader, val_loader=val_dataloader)
+
+    if distributed:
+        torch.distributed.destroy_process_group()
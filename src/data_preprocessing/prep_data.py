@@ -1,3 +1,4 @@
+import math
 import os
 from multiprocessing import Manager, Process, cpu_count
 from typing import Any
@@ -7,7 +8,8 @@ import pandas as pd
 import torch
 from datasets import concatenate_datasets, load_dataset, load_from_disk
 from sacremoses import MosesTokenizer
-from torch.utils.data import Dataset
+from torch import distributed as dist
+from torch.utils.data import Dataset, Sampler
 from transformers import AutoTokenizer
 
 from global_variables import DATA_DIR, EXT_DATA_DIR
@@ -106,7 +108,7 @@ class TranslationDataset(Dataset):
     def __init__(self, data):
         self.data = data
         self.languages = ["english", "french"]
-        self.types = ["idx", "sentences"]
+        self.types = ["idx", "sentences", "lengths"]
 
     def __len__(self):
         return len(
@@ -122,6 +124,67 @@ class TranslationDataset(Dataset):
         return sample
 
 
+class BucketSampler(Sampler):
+    """
+    Batch sampler grouping sentences of similar length, so that the padded
+    timesteps skipped by packed sequences make up most of the padding.
+
+    Sentences are sorted by length (ties broken at random), cut into batches
+    and the order of the batches is shuffled every epoch. In a distributed run
+    every process gets the same number of batches.
+
+    Args:
+        lengths (torch.Tensor): Length of every sentence of the dataset.
+        batch_size (int): Size of the batches.
+        shuffle (bool, optional): Shuffle the sentences and the batches. Default is True.
+        num_replicas (int, optional): Number of processes. Defaults to the world size of a distributed run, else 1.
+        rank (int, optional): Rank of the current process. Defaults to the distributed rank, else 0.
+        seed (int, optional): Seed of the shuffling. Default is 42.
+    """
+
+    def __init__(
+        self, lengths, batch_size, shuffle=True, num_replicas=None, rank=None, seed=42
+    ):
+        distributed = dist.is_available() and dist.is_initialized()
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if distributed else 1
+        if rank is None:
+            rank = dist.get_rank() if distributed else 0
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        num_batches = math.ceil(len(self.lengths) / self.batch_size)
+        return num_batches // self.num_replicas if self.num_replicas > 1 else num_batches
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        if self.shuffle:
+            order = torch.randperm(len(self.lengths), generator=generator)
+        else:
+            order = torch.arange(len(self.lengths))
+        order = order[torch.argsort(self.lengths[order], stable=True)]
+        batches = list(order.split(self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator)]
+
+        if self.num_replicas > 1:
+            # drop the last batches so that every process runs the same number of steps
+            batches = batches[: len(self) * self.num_replicas][self.rank :: self.num_replicas]
+        for batch in batches:
+            yield batch.tolist()
+
+
 class to_tensor:
     """
     Transform class to convert word IDs to PyTorch tensors.
@@ -266,10 +329,15 @@ def load_data(
     vocab_source="train",
     mp=True,
     only_vocab=False,
+    num_workers=None,
+    prefetch_factor=4,
+    distributed=False,
 ):
     """
     Load and preprocess data for training and validation.
     """
+    if num_workers is None:
+        num_workers = min(8, n_processors)
 
     print("Loading and preprocessing data...")
     mt_en = (
@@ -510,14 +578,31 @@ def load_data(
         val_english_sentences = []
         val_french_sentences = []
     # Organize data into a dictionary
+    # Number of tokens (<sos> included) before the padding of every sentence
     data = dict(
         train=dict(
-            english=dict(idx=idx_train_tensor_en, sentences=train_english_sentences),
-            french=dict(idx=idx_train_tensor_fr, sentences=train_french_sentences),
+            english=dict(
+                idx=idx_train_tensor_en,
+                sentences=train_english_sentences,
+                lengths=idx_train_tensor_en.ne(kx - 1).sum(dim=1),
+            ),
+            french=dict(
+                idx=idx_train_tensor_fr,
+                sentences=train_french_sentences,
+                lengths=idx_train_tensor_fr.ne(ky - 1).sum(dim=1),
+            ),
         ),
         val=dict(
-            english=dict(idx=idx_val_tensor_en, sentences=val_english_sentences),
-            french=dict(idx=idx_val_tensor_fr, sentences=val_french_sentences),
+            english=dict(
+                idx=idx_val_tensor_en,
+                sentences=val_english_sentences,
+                lengths=idx_val_tensor_en.ne(kx - 1).sum(dim=1),
+            ),
+            french=dict(
+                idx=idx_val_tensor_fr,
+                sentences=val_french_sentences,
+                lengths=idx_val_tensor_fr.ne(ky - 1).sum(dim=1),
+            ),
         ),
         bow=dict(
             english=np.array(tokenized_most_frequent_english_words),
@@ -527,11 +612,32 @@ def load_data(
     train_dataset = TranslationDataset(data["train"])
     val_dataset = TranslationDataset(data["val"])
 
+    # Pinned host memory allows asynchronous copies to the GPU, and persistent
+    # workers keep prefetching batches instead of being respawned every epoch
+    loader_kwargs = dict(
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
+        persistent_workers=num_workers > 0,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+    )
+    # Batches of sentences of similar length, each process of a distributed
+    # run only loads its own share of the training batches
     train_dataloader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=batch_size, shuffle=True
+        train_dataset,
+        batch_sampler=BucketSampler(
+            data["train"]["english"]["lengths"],
+            batch_size,
+            num_replicas=None if distributed else 1,
+            rank=None if distributed else 0,
+        ),
+        **loader_kwargs,
     )
     val_dataloader = torch.utils.data.DataLoader(
-        val_dataset, batch_size=batch_size, shuffle=True
+        val_dataset,
+        batch_sampler=BucketSampler(
+            data["val"]["english"]["lengths"], batch_size, num_replicas=1, rank=0
+        ),
+        **loader_kwargs,
     )
 
     # print some samples
@@ -4,6 +4,13 @@ import torch
 DATA_DIR = Path("data/local_data")
 EXT_DATA_DIR = Path("data/external_data")
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# bfloat16 has the range of float32 and needs no gradient scaling, it is used
+# on Ampere and newer GPUs (and on CPU where it is the autocast default)
+AMP_DTYPE = (
+    torch.bfloat16
+    if DEVICE == "cpu" or torch.cuda.get_device_capability()[0] >= 8
+    else torch.float16
+)
 
 STATS = {}
 WEIGHTS_STATS = {}
@@ -1,3 +1,4 @@
+import weakref
 from typing import Any, Dict
 
 import torch
@@ -6,7 +7,6 @@ import torch.nn.functional as F
 
 from models.fcnn import FCNN
 from models.rnn import RNN
-from global_variables import DEVICE
 
 
 class Alignment(nn.Module):
@@ -44,21 +44,25 @@ class Alignment(nn.Module):
             std=0.0,
         )
 
-    @torch.autocast(DEVICE)
-    def forward(self, s_emb: torch.Tensor, h_emb: torch.Tensor) -> torch.Tensor:
+    def forward(
+        self, s_emb: torch.Tensor, h_emb: torch.Tensor, src_mask: torch.Tensor = None
+    ) -> torch.Tensor:
         """
         Forward pass of the Alignment module.
 
         Args:
             s_emb (torch.Tensor): Tensor representing the context from the decoder.
             h_emb (torch.Tensor): Tensor representing the hidden states from the encoder.
+            src_mask (torch.Tensor, optional): False on the padded source positions,
+                broadcastable to the alignment vector. Their score is set to -inf.
 
         Returns:
             torch.Tensor: Alignment vector.
         """
-        return (
-            self.va(F.tanh(s_emb + h_emb))
-        )
+        scores = self.va(F.tanh(s_emb + h_emb))
+        if src_mask is not None:
+            scores = scores.masked_fill(~src_mask, float("-inf"))
+        return scores
 
 
 class OutputNetwork(nn.Module):
@@ -112,7 +116,6 @@ class OutputNetwork(nn.Module):
         )
         self.output_size = vocab_size
 
-    @torch.autocast(DEVICE)
     def forward(
         self, s_i: torch.Tensor, y_i: torch.Tensor, c_i: torch.Tensor
     ) -> torch.Tensor:
@@ -184,10 +187,37 @@ class Decoder(nn.Module):
             output_size=rnn["hidden_size"],
             device=embedding["device"],
         )
+        # One-hot start token, it moves with the module instead of being
+        # allocated on every forward pass
+        start_token = torch.zeros(output_nn["vocab_size"])
+        start_token[-2] = 1
+        self.register_buffer("start_token", start_token, persistent=False)
+
+
+    def initial_state(self, h: torch.Tensor, beam: int = 1):
+        """
+        Initial context vector and start token of the attention decoder.
+
+        Passing them to the first step, instead of None, keeps the inputs of
+        every step of the same kind, so that a compiled or captured step is not
+        specialised a second time for the first token.
+
+        Args:
+            h (torch.Tensor): The hidden states from the encoder.
+            beam (int): Number of consecutive hypotheses per source sentence.
 
+        Returns:
+            torch.Tensor: Context vector, of shape (batch_size * beam, hidden_size).
+            torch.Tensor: Start token, of shape (batch_size * beam, vocab_size).
+        """
+        # Initialize context vector as a learnable parameter
+        s_i = (
+            F.tanh(self.Ws(h[:,0,self.rnn.hidden_size :]))
+        ).repeat_interleave(beam, dim=0)
+        y_i = self.start_token.repeat(s_i.size(0), 1)
+        return s_i, y_i
 
-    @torch.autocast(DEVICE)
-    def forward(self, t: int , h, h_emb = None,s_i = None, y_i = None):
+    def forward(self, t: int , h, h_emb = None,s_i = None, y_i = None, src_mask = None):
         """
         Forward pass of the Decoder module.
 
@@ -196,7 +226,11 @@ class Decoder(nn.Module):
             h (torch.Tensor): The hidden states from the encoder.
             h_emb (torch.Tensor): The embeddings of the hidden states from the encoder.
             s_i (torch.Tensor): The context from the decoder.
-            y_i (torch.Tensor): The current output token.
+            y_i (torch.Tensor): The current output token. Its batch size may be a
+                multiple of the one of h, each source sentence then has a beam of
+                consecutive hypotheses.
+            src_mask (torch.Tensor): False on the padded positions of the source
+                sentences, these get no attention.
 
         Returns:
             torch.Tensor: Output tensor.
@@ -208,53 +242,131 @@ class Decoder(nn.Module):
         if not self.traditional:
             if h_emb is None:
                 raise ValueError("h_emb must be specified for attention model")
-            # Initialize context vector as a learnable parameter
-            if s_i is None:
-                s_i = (
-                    F.tanh(self.Ws(h[:,0,self.rnn.hidden_size :]))
-                )
-            if y_i is None:
-                y_i = torch.zeros(
-                    h.size(0),
-                    self.relaxation_nn.output_size,
-                    device=h.device,
-                    dtype=torch.float16,
-                )
-                y_i[:, -2] = 1
+            # y_i and s_i may hold several hypotheses (a beam) per source sentence,
+            # the encoder states are shared by the beam instead of being tiled
+            batch_size, Tx = h.size(0), h.size(1)
+            beam = 1 if y_i is None else y_i.size(0) // batch_size
+            n_hyp = batch_size * beam
+            if s_i is None or y_i is None:
+                s_0, y_0 = self.initial_state(h, beam)
+                s_i = s_0 if s_i is None else s_i
+                y_i = y_0 if y_i is None else y_i
             embed_y_i = self.embedding(y_i)
             
             # Compute the embedding of the current context vector
-            s_i_emb = self.alignment.nn_s(s_i.view(h.size(0), -1)).half()
+            s_i_emb = self.alignment.nn_s(s_i.view(n_hyp, -1))
             
-            # Compute alignment vector
-            a = self.alignment(s_i_emb.unsqueeze(1).repeat(1, h.size(1), 1),
-                                h_emb).squeeze(2)
+            # Compute alignment vector, broadcasting the beam against the encoder states
+            a = self.alignment(s_i_emb.view(batch_size, beam, 1, -1),
+                                h_emb.unsqueeze(1),
+                                None if src_mask is None else src_mask.view(batch_size, 1, Tx, 1),
+                                ).view(n_hyp, Tx)
             
 
             # Apply softmax to obtain attention weights
             e = F.softmax(a.float(), dim=1)
 
             # Compute context vector
-            c = torch.bmm(h.transpose(1, 2), e.unsqueeze(2)).squeeze(2)
+            c = torch.matmul(e.view(batch_size, beam, Tx), h).view(n_hyp, -1)
             
             # Compute output and update context vector
             _, s_i = self.rnn(
                 torch.cat((embed_y_i.unsqueeze(1).float(),
                             c.unsqueeze(1).float()), dim=2),
-                              s_i.unsqueeze(0)
+                              s_i.view(1, n_hyp, -1)
             )
-            s_i = s_i.squeeze()
+            s_i = s_i.squeeze(0)
 
             # Embed the output token and compute the output of the output network
             y_i = self.output_nn(
-                s_i.view(h.size(0), -1), embed_y_i.squeeze(1), c
+                s_i.view(n_hyp, -1), embed_y_i, c
             )
-
            
             # Store the output in the output tensor
             return y_i, s_i, e
         else:
-            with torch.autocast(DEVICE):
-                y_i_emb, s_i = self.rnn(h[:, t,:].view(h.shape[0], 1, -1),s_i)
+            y_i_emb, s_i = self.rnn(h[:, t,:].view(h.shape[0], 1, -1),s_i)
             y_i = self.relaxation_nn(y_i_emb)
             return y_i, s_i, None
+
+
+class DecoderGraphRunner:
+    """
+    Captures one attention step of a Decoder in a CUDA graph and replays it.
+
+    The inputs are copied into static buffers before every replay, so a runner
+    is only valid for the shapes it was captured with.
+
+    Args:
+        decoder (Decoder): The decoder whose step is captured.
+    """
+
+    def __init__(self, decoder: Decoder) -> None:
+        self.decoder = decoder
+        self.graph = None
+        self.static_inputs = ()
+        self.static_outputs = ()
+        self.sources = ()
+
+    @staticmethod
+    def _source(x):
+        # A weak reference and the version counter identify the tensor copied
+        # last without keeping it alive: the caching allocator may give the same
+        # address to the encoder states of the next batch
+        return None if x is None else (weakref.ref(x), x._version)
+
+    @staticmethod
+    def _same_source(source, x) -> bool:
+        return source is not None and source[0]() is x and source[1] == x._version
+
+    def capture(self, *inputs: torch.Tensor, warmup: int = 2) -> None:
+        """
+        Records the decoder step for the given inputs.
+
+        Args:
+            inputs (torch.Tensor): h, h_emb, s_i, y_i and src_mask as passed to
+                Decoder.forward, src_mask may be None.
+            warmup (int): Number of eager iterations run before the capture.
+        """
+        self.static_inputs = tuple(None if x is None else x.clone() for x in inputs)
+        self.sources = tuple(self._source(x) for x in inputs)
+
+        # Warm up on a side stream so that lazy initialisations are not captured
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), self._autocast():
+            for _ in range(warmup):
+                self.decoder(0, *self.static_inputs)
+        torch.cuda.current_stream().wait_stream(stream)
+        torch.cuda.synchronize()
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph), self._autocast():
+            self.static_outputs = self.decoder(0, *self.static_inputs)
+
+    @staticmethod
+    def _autocast():
+        # The autocast region of the caller without its cache of cast weights:
+        # casts cached during the capture would live in the private memory pool
+        # of the graph and be reused by the eager ops of the same region
+        return torch.autocast(
+            "cuda",
+            dtype=torch.get_autocast_dtype("cuda"),
+            enabled=torch.is_autocast_enabled("cuda"),
+            cache_enabled=False,
+        )
+
+    def __call__(self, *inputs: torch.Tensor):
+        """
+        Replays the captured step on new inputs.
+
+        Returns:
+            tuple: Copies of the decoder outputs (y_i, s_i, alignment).
+        """
+        for static, source, new in zip(self.static_inputs, self.sources, inputs):
+            # the encoder states do not change between the steps of a sentence
+            if static is not None and not self._same_source(source, new):
+                static.copy_(new)
+        self.sources = tuple(self._source(x) for x in inputs)
+        self.graph.replay()
+        return tuple(x.clone() for x in self.static_outputs)
@@ -1,7 +1,6 @@
 import torch.nn as nn
 
 from models.rnn import RNN
-from global_variables import DEVICE
 import torch
 from models.fcnn import FCNN
 
@@ -14,6 +13,7 @@ class Encoder(nn.Module):
         rnn_type = kwargs.get("rnn_type", "GRU")
         embedding_size = kwargs.get("embedding_size", 5)
         dropout = kwargs.get("dropout", 0.0)
+        compile = kwargs.get("compile", False)
         super().__init__()
         self.vocab_size = vocab_size
         # Utiliser la classe RNN dans Encoder
@@ -32,13 +32,16 @@ class Encoder(nn.Module):
             device=rnn_device,
             dropout=dropout,
         )
+        if compile:
+            # Only the one-hot embedding and its dropout end up in an Inductor graph,
+            # specialised on the padded sentence length Tx: Dynamo does not trace
+            # RNN, GRU or LSTM modules, the recurrent layer runs eagerly
+            self.compile(mode="reduce-overhead", dynamic=False)
 
-    @torch.autocast(DEVICE)
-    def forward(self, x):
-        x = torch.nn.functional.one_hot(x.long(), self.vocab_size).half()   
+    def forward(self, x, lengths=None):
+        x = torch.nn.functional.one_hot(x.long(), self.vocab_size).float()
         # Appliquer l'embedding
-        embedded = self.embedding(x.float())
+        embedded = self.embedding(x)
         # Appeler la classe RNN pour obtenir output et hidden
-        with torch.autocast(DEVICE):
-            rnn_output, rnn_hidden = self.rnn(embedded)
+        rnn_output, rnn_hidden = self.rnn(embedded, lengths=lengths)
         return rnn_output, rnn_hidden
@@ -1,7 +1,157 @@
+from typing import List, Tuple
+
 import torch
-from torch import nn
+from torch import Tensor, jit, nn
 from torch.nn import init
-from global_variables import DEVICE
+
+
+class LSTMCell(jit.ScriptModule):
+    """
+    LSTM cell compiled with TorchScript so that the gate nonlinearities and
+    the elementwise state update are fused into a single kernel per step.
+
+    Args:
+        input_size (int): The number of expected features in the input x.
+        hidden_size (int): The number of features in the hidden state h.
+    """
+
+    def __init__(self, input_size, hidden_size):
+        super(LSTMCell, self).__init__()
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.weight_ih = nn.Parameter(torch.randn(4 * hidden_size, input_size))
+        self.weight_hh = nn.Parameter(torch.randn(4 * hidden_size, hidden_size))
+        self.bias_ih = nn.Parameter(torch.randn(4 * hidden_size))
+        self.bias_hh = nn.Parameter(torch.randn(4 * hidden_size))
+
+    @jit.script_method
+    def forward(
+        self, x: Tensor, state: Tuple[Tensor, Tensor]
+    ) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
+        hx, cx = state
+        gates = (
+            torch.mm(x, self.weight_ih.t())
+            + self.bias_ih
+            + torch.mm(hx, self.weight_hh.t())
+            + self.bias_hh
+        )
+        ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+
+        ingate = torch.sigmoid(ingate)
+        forgetgate = torch.sigmoid(forgetgate)
+        cellgate = torch.tanh(cellgate)
+        outgate = torch.sigmoid(outgate)
+
+        cy = (forgetgate * cx) + (ingate * cellgate)
+        hy = outgate * torch.tanh(cy)
+
+        return hy, (hy, cy)
+
+
+class LSTMLayer(jit.ScriptModule):
+    """
+    Runs an LSTMCell over the time dimension of a batch first input.
+
+    Args:
+        input_size (int): The number of expected features in the input x.
+        hidden_size (int): The number of features in the hidden state h.
+        reverse (bool, optional): If True, the sequence is processed from the last step to the first. Default is False.
+    """
+
+    def __init__(self, input_size, hidden_size, reverse=False):
+        super(LSTMLayer, self).__init__()
+        self.cell = LSTMCell(input_size, hidden_size)
+        self.reverse = reverse
+
+    @jit.script_method
+    def forward(
+        self, x: Tensor, state: Tuple[Tensor, Tensor]
+    ) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
+        if self.reverse:
+            x = x.flip(1)
+        inputs = x.unbind(1)
+        outputs = jit.annotate(List[Tensor], [])
+        for i in range(len(inputs)):
+            out, state = self.cell(inputs[i], state)
+            outputs += [out]
+        out = torch.stack(outputs, 1)
+        if self.reverse:
+            out = out.flip(1)
+        return out, state
+
+
+class JitLSTM(nn.Module):
+    """
+    Drop-in replacement for a batch first torch.nn.LSTM built from TorchScript
+    LSTM layers. It takes and returns the same tensors as torch.nn.LSTM.
+
+    Args:
+        input_size (int): The number of expected features in the input x.
+        hidden_size (int): The number of features in the hidden state h.
+        num_layers (int): Number of recurrent layers.
+        batch_first (bool, optional): Only batch first inputs are supported. Default is True.
+        dropout (float, optional): If non-zero, introduces a Dropout layer on the outputs of each LSTM layer except the last layer. Default is 0.
+        bidirectional (bool, optional): If True, becomes a bidirectional LSTM. Default is False.
+    """
+
+    def __init__(
+        self,
+        input_size,
+        hidden_size,
+        num_layers=1,
+        batch_first=True,
+        dropout=0,
+        bidirectional=False,
+    ):
+        super(JitLSTM, self).__init__()
+        if not batch_first:
+            raise ValueError("JitLSTM only supports batch_first inputs")
+
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.batch_first = batch_first
+        self.dropout = dropout
+        self.bidirectional = bidirectional
+        num_directions = 2 if bidirectional else 1
+
+        self.layers = nn.ModuleList()
+        for layer in range(num_layers):
+            layer_input_size = input_size if layer == 0 else hidden_size * num_directions
+            for direction in range(num_directions):
+                self.layers.append(
+                    LSTMLayer(layer_input_size, hidden_size, reverse=direction == 1)
+                )
+        self.dropout_layer = nn.Dropout(dropout)
+
+    def forward(self, x, state):
+        """
+        Forward pass of the LSTM.
+
+        Parameters:
+            x (torch.Tensor): Input tensor of shape (batch, seq_len, input_size).
+            state (tuple): Initial hidden and cell states, each of shape (num_layers * num_directions, batch, hidden_size).
+
+        Returns:
+            torch.Tensor: Output tensor of the last layer.
+            tuple: Final hidden and cell states.
+        """
+        h0, c0 = state
+        num_directions = 2 if self.bidirectional else 1
+        hidden, cell = [], []
+        out = x
+        for layer in range(self.num_layers):
+            if layer > 0:
+                out = self.dropout_layer(out)
+            outputs = []
+            for direction in range(num_directions):
+                idx = layer * num_directions + direction
+                layer_out, (h, c) = self.layers[idx](out, (h0[idx], c0[idx]))
+                outputs.append(layer_out)
+                hidden.append(h)
+                cell.append(c)
+            out = torch.cat(outputs, dim=2)
+        return out, (torch.stack(hidden), torch.stack(cell))
 
 
 class RNN(nn.Module):
@@ -47,6 +197,7 @@ class RNN(nn.Module):
             device (str): Device to which the model is moved (e.g., 'cuda' or 'cpu').
             activation (str, optional): Type of nonlinearity. Default is 'tanh'.
             dropout (float, optional): If non-zero, introduces a Dropout layer on the outputs of each RNN layer except the last layer. Default is 0.
+            type (str, optional): One of 'RNN', 'LSTM', 'JitLSTM' (TorchScript fused LSTM) or 'GRU'. Default is 'RNN'.
         """
         super(RNN, self).__init__()
 
@@ -55,7 +206,13 @@ class RNN(nn.Module):
         self.num_layers = num_layers
         self.input_size = input_size
         network_type = (
-            nn.RNN if type == "RNN" else nn.LSTM if type == "LSTM" else nn.GRU
+            nn.RNN
+            if type == "RNN"
+            else nn.LSTM
+            if type == "LSTM"
+            else JitLSTM
+            if type == "JitLSTM"
+            else nn.GRU
         )
         self.rnn = network_type(
             input_size,
@@ -65,50 +222,116 @@ class RNN(nn.Module):
             dropout=dropout,
             bidirectional=bidirectional,
         )
+        # Zero initial states reused across calls, keyed by batch size and dtype
+        self._h0_cache: dict[tuple, torch.Tensor] = {}
+        self._c0_cache: dict[tuple, torch.Tensor] = {}
         # Initialize weights
         self.init_weights()
 
-    @torch.autocast(DEVICE)
-    def forward(self, x, h0=None):
+    def zero_state(self, cache, batch_size, dtype):
+        """
+        Returns a zero initial state for the given batch size and dtype.
+
+        The tensor is allocated on the first call for each batch size and reused
+        afterwards, so it keeps a stable address (required for CUDA graph replay).
+        It is never written to, hence it is not re-zeroed: an in-place zero_()
+        would invalidate the copy saved by autograd for a previous step.
+
+        Parameters:
+            cache (dict): Cache of zero tensors keyed by batch size and dtype.
+            batch_size (int): Size of the batch.
+            dtype (torch.dtype): Data type of the state.
+
+        Returns:
+            torch.Tensor: Zero tensor of shape (num_layers * num_directions, batch_size, hidden_size).
+        """
+        buf = cache.get((batch_size, dtype))
+        if buf is None:
+            buf = torch.empty(
+                self.num_layers * (2 if self.rnn.bidirectional else 1),
+                batch_size,
+                self.hidden_size,
+                device=self.device,
+                dtype=dtype,
+            ).zero_()
+            cache[(batch_size, dtype)] = buf
+        return buf
+
+    def forward(self, x, h0=None, lengths=None):
         """
         Forward pass of the RNN.
 
+        Mixed precision is left to the autocast region of the caller, the zero
+        initial states follow the dtype of the input.
+
         Parameters:
             x (torch.Tensor): Input tensor.
+            h0 (torch.Tensor, optional): Initial hidden state.
+            lengths (torch.Tensor, optional): Length of every sequence of the batch (on the CPU).
+                When given, the padded timesteps are skipped and their outputs are zeros.
+                Not supported by the 'JitLSTM' type, which raises a ValueError.
 
         Returns:
             torch.Tensor: Output tensor.
         """
         # Initialize hidden state
         if h0 is None:
-            h0 = torch.zeros(
-                self.num_layers * (2 if self.rnn.bidirectional else 1),
-                x.size(0),
-                self.hidden_size,
-                device=self.device,
-                dtype=torch.float16,
-            )
+            h0 = self.zero_state(self._h0_cache, x.size(0), x.dtype)
         c0 = None
-        if isinstance(self.rnn, nn.LSTM):
-            c0 = torch.zeros(
-                self.num_layers * (2 if self.rnn.bidirectional else 1),
-                x.size(0),
-                self.hidden_size,
-                device=self.device,
-                dtype=torch.float16,
+        if isinstance(self.rnn, (nn.LSTM, JitLSTM)):
+            c0 = self.zero_state(self._c0_cache, x.size(0), x.dtype)
+
+        # The scripted LSTM has no support for packed sequences, its backward
+        # direction would start from the padding
+        if lengths is not None and isinstance(self.rnn, JitLSTM):
+            raise ValueError("JitLSTM does not support lengths, pass padded inputs without lengths")
+        packed = lengths is not None
+        total_length = x.size(1)
+        if packed:
+            x = nn.utils.rnn.pack_padded_sequence(
+                x, lengths, batch_first=True, enforce_sorted=False
             )
-            out, (hidden, _) = self.rnn(x, (h0, c0))
-            
+
         # Forward propagate RNN
         out, hidden = self.rnn(x, h0 if c0 is None else (h0, c0))
-        return out.half(), (hidden[0] if isinstance(hidden, tuple) else hidden).half()
+        if packed:
+            out, _ = nn.utils.rnn.pad_packed_sequence(
+                out, batch_first=True, total_length=total_length
+            )
+        return out, hidden[0] if isinstance(hidden, tuple) else hidden
 
     def init_weights(self):
+        orthogonal = {}
         for name, param in self.named_parameters():
             if "weight" in name:
                 if "rnn" in name or "lstm" in name or "gru" in name or "hh" in name:
-                    init.orthogonal_(param.data)
+                    orthogonal.setdefault(param.shape, []).append(param)
                 else:
                     init.normal_(param.data, mean=0, std=0.01)
             if "bias" in name:
                 init.constant_(param.data, val=0)
+        for params in orthogonal.values():
+            self.batched_orthogonal_(params)
+
+    @torch.no_grad()
+    def batched_orthogonal_(self, params):
+        """
+        Fills parameters of the same shape with (semi) orthogonal matrices, as
+        init.orthogonal_ does, with a single batched QR decomposition. The
+        decomposition runs on the device of the module when it is a GPU.
+
+        Parameters:
+            params (list): Parameters sharing the same 2D shape.
+        """
+        rows, cols = params[0].shape
+        device = self.device if torch.device(self.device).type == "cuda" else "cpu"
+        flat = torch.randn(len(params), rows, cols, device=device)
+        if rows < cols:
+            flat = flat.transpose(1, 2)
+        q, r = torch.linalg.qr(flat)
+        # Make the decomposition unique, as in init.orthogonal_
+        q *= torch.sign(torch.diagonal(r, dim1=1, dim2=2)).unsqueeze(1)
+        if rows < cols:
+            q = q.transpose(1, 2)
+        for param, q_i in zip(params, q):
+            param.copy_(q_i)
@@ -3,20 +3,57 @@ import math
 import os
 from typing import List
 from torch.cuda.amp import GradScaler
+import onnx
 import torch
 from sacremoses import MosesDetokenizer, MosesTokenizer
+from torch import distributed as dist
 from torch import nn
 from torch.nn import functional as F
+from torch.nn.parallel import DistributedDataParallel
 
 from data_preprocessing import *
 from global_variables import *
 from metrics import bleu_seq
 from metrics.losses import Loss
-from models.decoder import Decoder
+from models.decoder import Decoder, DecoderGraphRunner
 from models.encoder import Encoder
 from utils.plotting import *
 
 
+class InferenceModel(nn.Module):
+    """
+    Inference only view of an AlignAndTranslate model, used to export or compile
+    its forward pass. Exporters switch the mode of the module with train() and
+    eval(), which AlignAndTranslate overrides with its own training and
+    evaluation loops.
+
+    Args:
+        model (AlignAndTranslate): The model to run.
+        autocast (bool): Run in mixed precision, off for the ONNX export: ONNX
+            has no bfloat16 LSTM.
+    """
+
+    def __init__(self, model, autocast: bool = True) -> None:
+        super().__init__()
+        # Registered so that their weights belong to the exported graph
+        self.encoder = model.encoder
+        self.decoder = model.decoder
+        self.__dict__["model"] = model
+        self.autocast = autocast
+
+    def forward(self, x: torch.Tensor, lengths: torch.Tensor):
+        """
+        Runs the model as in training, with the padding of the source sentences
+        skipped by the encoder and masked in the attention.
+
+        Args:
+            x (torch.Tensor): Padded source sentences.
+            lengths (torch.Tensor): Their lengths (on the CPU).
+        """
+        with torch.autocast(DEVICE, dtype=AMP_DTYPE, enabled=self.autocast):
+            return self.model(x, lengths)
+
+
 class AlignAndTranslate(nn.Module):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__()
@@ -44,7 +81,23 @@ class AlignAndTranslate(nn.Module):
         self.start_time = self.timestamp
         self.Tx = training_config["Tx"]
         self.Ty = training_config["Ty"]
-        self.scaler = GradScaler()
+        # Gradient scaling is only needed to avoid underflows in float16
+        self.scaler = GradScaler(enabled=AMP_DTYPE == torch.float16)
+        # Opt-in until the captured decoder step has been validated on a GPU
+        self.cuda_graph = training_config.get("cuda_graph", False)
+        self.compiled = training_config.get("compile", False)
+        if self.compiled:
+            # Compiled in place so that the state dict keys stay unchanged.
+            # Dynamo does not trace the recurrent layers, the decoder step is
+            # compiled in graphs around its LSTM call. They are specialised on
+            # the grad mode, the beam size and the batch size: the full and the
+            # last batch of training and validation, the beam search rows of
+            # display and translate_sentence. Dynamic shapes would add guards on
+            # the views passed as states instead of saving compilations
+            torch._dynamo.config.recompile_limit = max(torch._dynamo.config.recompile_limit, 16)
+            self.decoder.compile(mode="reduce-overhead", dynamic=False)
+        self.graph_runners = {}
+        self.parallel_model = None
 
         self.train_losses = []
         self.val_losses = [1e10]
@@ -60,6 +113,11 @@ class AlignAndTranslate(nn.Module):
                     self.load_last_model()
                 except:
                     time = self.timestamp
+        if dist.is_initialized():
+            # every process uses the run folder of the main process
+            time = [time]
+            dist.broadcast_object_list(time, src=0)
+            time = time[0]
         self.create_folders(time)
 
 
@@ -71,6 +129,9 @@ class AlignAndTranslate(nn.Module):
         self.output_dir = self.local_dir / "outputs/"
         self.plot_dir = self.local_dir / "plots/"
         self.bleu_scores = [0.0]
+        # Only the main process of a distributed run writes outputs
+        if not self.is_main_process:
+            return
         os.makedirs(DATA_DIR / "trained_models/", exist_ok=True)
         os.makedirs(self.local_dir, exist_ok=True)
         os.makedirs(self.models_dir, exist_ok=True)
@@ -78,37 +139,138 @@ class AlignAndTranslate(nn.Module):
         os.makedirs(self.best_models_dir, exist_ok=True)
         os.makedirs(self.plot_dir, exist_ok=True)
 
-    @torch.autocast(DEVICE)
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        # Forward pass through encoder and decoder
-        encoder_output, _ = self.encoder(x)
-        
+    def forward(self, x: torch.Tensor, lengths: torch.Tensor = None) -> torch.Tensor:
+        # Forward pass through encoder and decoder, mixed precision is left
+        # to the autocast region of the caller (train_step, evaluate, ...)
+        return self.decode(*self.encode(x, lengths))
+
+    def encode(self, x: torch.Tensor, lengths: torch.Tensor = None):
+        """
+        Runs the encoder once for a batch of source sentences.
+
+        Args:
+            x (torch.Tensor): Padded source sentences.
+            lengths (torch.Tensor, optional): Their lengths (on the CPU), the
+                encoder skips the padding when given.
+
+        Returns:
+            torch.Tensor: Encoder hidden states.
+            torch.Tensor: Their embedding used by the alignment model.
+            torch.Tensor: Mask of the source tokens (False on the padding), None without lengths.
+        """
+        encoder_output, _ = self.encoder(x, lengths)
+        # Packed sequences are padded back as a transposed view, the decoder
+        # steps (compiled or captured) are specialised on contiguous states
+        encoder_output = encoder_output.contiguous()
         h_emb = self.decoder.alignment.nn_h(encoder_output)
+        src_mask = None
+        if lengths is not None:
+            src_mask = (
+                torch.arange(x.size(1), device=lengths.device).unsqueeze(0)
+                < lengths.unsqueeze(1)
+            ).to(encoder_output.device, non_blocking=True)
+        return encoder_output, h_emb, src_mask
+
+    def decode(self, encoder_output: torch.Tensor, h_emb: torch.Tensor, src_mask: torch.Tensor = None):
+        """
+        Runs the decoder for Ty steps on precomputed encoder states.
+
+        Returns:
+            torch.Tensor: Decoder outputs.
+            torch.Tensor: Alignments.
+        """
         s_i = None # the initialization is directly handled in the decoder
         y_i= None # the initialization is directly handled in the decoder
+        if not self.decoder.traditional:
+            # the first step gets tensors too, so that it runs the same graph as the others
+            s_i, y_i = self.decoder.initial_state(encoder_output)
+            if self.compiled:
+                # the following tokens are decoder outputs, which require gradients
+                # in training, a compiled step would be specialised again for t=0
+                y_i.requires_grad_(torch.is_grad_enabled())
         allignments = []
-        decoder_output = torch.zeros((x.shape[0], self.Ty, self.decoder.relaxation_nn.output_size), device=self.device)
+        decoder_output = []
         for t in range(self.Ty):
-            if y_i is not None:
-                y_i = F.softmax(y_i, dim=-1)
-            y_i, s_i, a_i = self.decoder(t,encoder_output, h_emb, s_i, y_i)
+            y_i, s_i, a_i = self.decode_step(t, encoder_output, h_emb, s_i, y_i, src_mask)
 
             allignments.append(a_i) 
 
-            decoder_output[:, t, :] = y_i
+            decoder_output.append(y_i)
+            # float32 like the start token, whatever the autocast policy of softmax
+            y_i = F.softmax(y_i, dim=-1, dtype=torch.float32)
 
+        decoder_output = torch.stack(decoder_output, dim=1).float()
         allignments = torch.stack(allignments, dim=1)
         return (decoder_output, allignments)
 
+    def decode_step(self, t, encoder_output, h_emb, s_i, y_i, src_mask=None):
+        """
+        Runs one step of the decoder.
+
+        With cuda_graph enabled, without gradients on a CUDA device, the attention step is captured once
+        per input shape in a CUDA graph and replayed for the following tokens.
+        A step without s_i or y_i (see Decoder.initial_state) and the traditional
+        model run eagerly.
+        """
+        if self.compiled and not torch.is_grad_enabled() and encoder_output.is_cuda:
+            # Without gradients, every call replays the CUDA graphs recorded by
+            # reduce-overhead into the same output buffers, the outputs the
+            # caller keeps across steps are copied
+            outputs = self.decoder(t, encoder_output, h_emb, s_i, y_i, src_mask)
+            return tuple(None if x is None else x.clone() for x in outputs)
+        if (
+            not self.cuda_graph
+            or torch.is_grad_enabled()
+            or self.decoder.traditional
+            or s_i is None
+            or y_i is None
+            or not encoder_output.is_cuda
+        ):
+            return self.decoder(t, encoder_output, h_emb, s_i, y_i, src_mask)
+
+        key = (encoder_output.shape, s_i.shape, y_i.shape, src_mask is None)
+        runner = self.graph_runners.get(key)
+        if runner is None:
+            runner = DecoderGraphRunner(self.decoder)
+            runner.capture(encoder_output, h_emb, s_i, y_i, src_mask)
+            self.graph_runners[key] = runner
+        return runner(encoder_output, h_emb, s_i, y_i, src_mask)
+
+    def distribute(self) -> None:
+        """
+        Wraps the model in DistributedDataParallel for the training steps.
+
+        The process group must already be initialized and the model on the
+        device of its rank.
+        """
+        # Stored outside of the submodules, otherwise the wrapper would
+        # register itself as a child of the module it wraps
+        self.__dict__["parallel_model"] = DistributedDataParallel(
+            self,
+            # without device_ids the inputs are not moved: the lengths stay on
+            # the CPU for pack_padded_sequence and the source mask, train_step
+            # moves the tokens itself
+            device_ids=None,
+            # the decoder does not use all its layers in a given mode
+            find_unused_parameters=True,
+        )
+
+    @property
+    def is_main_process(self) -> bool:
+        return not dist.is_initialized() or dist.get_rank() == 0
+
     def calc_loss(self, output: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
         loss = self.criterion(output, y)
         return loss
 
-    def train_step(self, x: torch.Tensor, y: torch.Tensor) -> float:
+    def train_step(self, x: torch.Tensor, y: torch.Tensor, lengths: torch.Tensor = None) -> float:
         # Training step
         self.optimizer.zero_grad()
-        output, allignments = self.forward(x.to(self.device))
-        loss = self.calc_loss(output, y.to(self.device))
+        model = self if self.parallel_model is None else self.parallel_model
+        # Mixed precision for the whole step, gradients are scaled by self.scaler
+        with torch.autocast(DEVICE, dtype=AMP_DTYPE):
+            output, allignments = model(x.to(self.device, non_blocking=True), lengths)
+            loss = self.calc_loss(output, y.to(self.device, non_blocking=True))
         self.scaler.scale(loss).backward()
         # # Gradient Value Clipping
         self.scaler.unscale_(self.optimizer)
@@ -119,6 +281,9 @@ class AlignAndTranslate(nn.Module):
         return loss.item(), output, allignments
 
     def save_model(self, best: bool = False) -> None:
+        # Only one process of a distributed run writes checkpoints
+        if not self.is_main_process:
+            return
         # Create a directory with timestamp
         save_dir = os.path.join(
             self.models_dir if not best else self.best_models_dir, self.timestamp
@@ -164,6 +329,8 @@ class AlignAndTranslate(nn.Module):
         # Training loop
         for epoch in range(math.ceil(self.epochs)):
             losses = []
+            if hasattr(train_loader.batch_sampler, "set_epoch"):
+                train_loader.batch_sampler.set_epoch(epoch)
             for i, train_sample in enumerate(train_loader):
                 exact_epoch = epoch + i / len(train_loader)
                 if exact_epoch > self.epochs:
@@ -172,54 +339,58 @@ class AlignAndTranslate(nn.Module):
                     train_sample["english"]["idx"],
                     train_sample["french"]["idx"],
                 )
-                x = x.to(self.device)
-                y = y.to(self.device)
-                loss, output, allignments = self.train_step(x, y)
+                lengths = train_sample["english"]["lengths"]
+                x = x.to(self.device, non_blocking=True)
+                y = y.to(self.device, non_blocking=True)
+                loss, output, allignments = self.train_step(x, y, lengths)
                 losses.append(loss)
 
-                if i % self.print_every == 0:
+                if i % self.print_every == 0 and self.is_main_process:
                     print(f"Epoch: {epoch}, Batch: {i}, Loss: {loss}, Mean Loss: {sum(losses) / len(losses)}")
                     # plot a sample 
                     if i % (self.print_every * 10) == 0:
-                        self.display(output, allignments, x, y, val=False)
+                        self.display(output, allignments, x, y, val=False, lengths=lengths)
                     # stylish_stat_print(STATS)
                     # stylish_stat_print(WEIGHTS_STATS)
                     # add losses to a text file
                 if i % self.save_every == 0:
                     self.save_model()
-                with open(
-                    self.output_dir / "train_losses.txt",
-                    "a" if not train_file_exists else "w",
-                ) as myfile:
-                    myfile.write(f"{loss}\n")
+                if self.is_main_process:
+                    with open(
+                        self.output_dir / "train_losses.txt",
+                        "a" if not train_file_exists else "w",
+                    ) as myfile:
+                        myfile.write(f"{loss}\n")
             val_losses = []
             with torch.no_grad():
                 val_loss = self.evaluate(val_loader)
                 val_losses.append(val_loss)
                 self.val_losses.append(val_loss)
-                self.display(output, allignments, x, y, val=False)
-                print(f"Epoch: {epoch}, Validation Loss: {val_loss}")
-                with open(
-                    self.output_dir / "val_losses.txt",
-                    "a" if not val_file_exists else "w",
-                ) as myfile:
-                    myfile.write(f"{val_loss}\n")
+                self.display(output, allignments, x, y, val=False, lengths=lengths)
+                if self.is_main_process:
+                    print(f"Epoch: {epoch}, Validation Loss: {val_loss}")
+                    with open(
+                        self.output_dir / "val_losses.txt",
+                        "a" if not val_file_exists else "w",
+                    ) as myfile:
+                        myfile.write(f"{val_loss}\n")
             self.train_losses.append(sum(losses) / len(losses))
 
-            losses_exist = os.path.exists(self.output_dir / "losses.txt")
-
-            with open(
-                self.output_dir / "losses.txt",
-                "a" if not losses_exist else "w",
-                encoding="utf-8",
-            ) as myfile:
-                myfile.write(
-                    "{} {} {}\n".format(
-                        self.train_losses[-1],
-                        self.val_losses[-1],
-                        torch.mean(self.bleu_scores[-1]).half(),
+            if self.is_main_process:
+                losses_exist = os.path.exists(self.output_dir / "losses.txt")
+
+                with open(
+                    self.output_dir / "losses.txt",
+                    "a" if not losses_exist else "w",
+                    encoding="utf-8",
+                ) as myfile:
+                    myfile.write(
+                        "{} {} {}\n".format(
+                            self.train_losses[-1],
+                            self.val_losses[-1],
+                            torch.mean(self.bleu_scores[-1]).half(),
+                        )
                     )
-                )
 
             if sum(val_losses) / len(val_losses) < self.best_val_loss:
                 self.best_val_loss = sum(val_losses) / len(val_losses)
@@ -232,10 +403,18 @@ class AlignAndTranslate(nn.Module):
         x: torch.tensor,
         y: torch.tensor,
         val: bool = True,
+        lengths: torch.Tensor = None,
     ):
+        # Only the main process of a distributed run prints, writes and plots samples
+        if not self.is_main_process:
+            return
         random_idx = torch.randint(0, len(x), (4,))
         if self.beam_search_flag:
-            prediction_idx, _ = self.beam_search_decoder(x[random_idx])
+            with torch.autocast(DEVICE, dtype=AMP_DTYPE):
+                prediction_idx, _ = self.beam_search_decoder(
+                    x[random_idx],
+                    lengths=None if lengths is None else lengths[random_idx],
+                )
         else:
             prediction = output[random_idx]
             prediction[:, :, -3] = torch.min(
@@ -269,12 +448,14 @@ class AlignAndTranslate(nn.Module):
         total_loss = 0
         for i, val_sample in enumerate(val_loader):
             x, y = val_sample["english"]["idx"], val_sample["french"]["idx"]
-            output, allignments = self.forward(x.to(self.device))
+            lengths = val_sample["english"]["lengths"]
+            with torch.autocast(DEVICE, dtype=AMP_DTYPE):
+                output, allignments = self.forward(x.to(self.device, non_blocking=True), lengths)
 
-            loss = self.calc_loss(output, y.to(self.device))
+                loss = self.calc_loss(output, y.to(self.device, non_blocking=True))
             total_loss += loss.item()
             if i == 0:
-                self.display(output, allignments, x, y, val=True)
+                self.display(output, allignments, x, y, val=True, lengths=lengths)
 
         return total_loss / len(val_loader)
 
@@ -311,78 +492,85 @@ class AlignAndTranslate(nn.Module):
         phrase = phrase.replace("  ", " ")
         return phrase
     
-    def beam_search_decoder(self, x: torch.Tensor, beam_size: int = 10) -> torch.Tensor:
+    def beam_search_decoder(self, x: torch.Tensor, beam_size: int = 10, encoded=None, lengths=None) -> torch.Tensor:
+        """
+        Beam search run in parallel over the sentences of the batch.
+
+        Every sentence has beam_size hypotheses, stored in consecutive rows, so
+        that each step is a single decoder call on batch_size * beam_size rows
+        with the encoder states shared by the beam. A hypothesis is finished once
+        it produced <pad>. Tokens repeating the preceding tokens are forbidden.
+
+        The source sentences are encoded with their lengths (on the CPU) when
+        given, unless the caller passes their encoder states as encoded.
+
+        Returns:
+            torch.Tensor: Best sequence of every sentence, of shape (batch_size, Ty).
+            torch.Tensor: Its alignments, of shape (batch_size, Ty, Tx).
+        """
         with torch.no_grad():
-            encoder_output, _ = self.encoder(x.to(self.device))
-            h_emb = self.decoder.alignment.nn_h(encoder_output)
+            # reuse the encoder states when the caller already computed them
+            if encoded is None:
+                encoded = self.encode(x.to(self.device), lengths)
+            encoder_output, h_emb, src_mask = encoded
 
             batch_size, vocab_size = x.shape[0], len(self.target_vocab) + 2
-            sos_token, unk_token, pad_token = vocab_size - 2, vocab_size - 3, vocab_size - 1
-
-            output = torch.zeros(batch_size, self.Ty, device=self.device)
-            alignments = torch.zeros(batch_size, self.Ty, self.Ty, device=self.device)
-
-            for b in range(batch_size):
-                first_candidate_seq = torch.full((self.Ty+2,), pad_token, device=self.device, dtype=torch.long)
-                first_candidate_seq[0] = sos_token
-                candidates = [(first_candidate_seq, 0.0, None, [])]
-
-                for t in range(self.Ty+1):
-                    new_candidates = []
-                    for seq, score, s_i, align in candidates:
-                        if seq[t] == pad_token:
-                            new_candidates.append((seq, score, s_i, align))
-                            continue
-                        y_i, s_i, a_i = self.decoder(t, encoder_output[b:b+1], h_emb[b:b+1],
-                                                    s_i, torch.nn.functional.one_hot(seq[t:t+1], num_classes=vocab_size).float())
-                        scores = F.log_softmax(y_i, dim=-1)
-                        cumulative_scores = score + scores.squeeze()
-                        s_i = s_i.view(1,-1)
-                        top_k_scores, top_k_indices = torch.topk(cumulative_scores, beam_size)
-
-                        for i in range(beam_size):
-                            new_seq = seq.clone()
-                            # avoid repetition
-                            repetition = False
-                            temp_seq = new_seq.clone()[:t]
-                            # check repetitions
-                            for length in range(t):
-                                concatenated = torch.cat(
-                                    [
-                                        temp_seq[len(temp_seq) - length :],
-                                        torch.tensor([top_k_indices[i]], dtype=torch.int64, device=self.device),
-                                    ]
-                                )
-                                previous = seq[
-                                    len(temp_seq) - 2 * length - 1 : len(temp_seq) - length
-                                ]
-                                if len(previous) == len(concatenated):
-                                    repetition = (concatenated == previous).all()
-                                if repetition:
-                                    break
-                            if not repetition:
-                                new_seq[t+1] = top_k_indices[i]
-                                new_score = top_k_scores[i]
-                                new_align = align + [a_i]
-                                new_candidates.append((new_seq, new_score, s_i, new_align))
-
-                    candidates = sorted(new_candidates, key=lambda x: x[1], reverse=True)[:beam_size]
-
-                best_seq, _, _, best_align = max(candidates, key=lambda x: x[1])
-                best_seq = best_seq[1: -1]
-                #remove first alignment
-                best_align = best_align[1:]
-                #remove last 
-                output[b] = best_seq
-                try:
-                    alignments[b][:len(best_align)] = torch.stack(best_align, dim=0).squeeze()
-                except:
-                    pass
+            sos_token, pad_token = vocab_size - 2, vocab_size - 1
+            n_hyp = batch_size * beam_size
+
+            seqs = torch.full((n_hyp, self.Ty + 2), pad_token, device=self.device, dtype=torch.long)
+            seqs[:, 0] = sos_token
+            # a single live hypothesis per sentence at the start
+            scores = torch.full((batch_size, beam_size), float("-inf"), device=self.device)
+            scores[:, 0] = 0.0
+            alignments = torch.zeros(n_hyp, self.Ty + 1, encoder_output.size(1), device=self.device)
+            first_row = (torch.arange(batch_size, device=self.device) * beam_size).unsqueeze(1)
+
+            s_i, _ = self.decoder.initial_state(encoder_output, beam_size)
+            # a copy instead of a view, as the states gathered for the following
+            # steps, so that a compiled step sees the same kind of input
+            s_i = s_i.clone()
+            for t in range(self.Ty + 1):
+                finished = seqs[:, t] == pad_token
+                y_i = F.one_hot(seqs[:, t], num_classes=vocab_size).float()
+                y_i, s_i, a_i = self.decode_step(t, encoder_output, h_emb, s_i, y_i, src_mask)
+                s_i = s_i.view(n_hyp, -1)
+                log_probs = F.log_softmax(y_i.float(), dim=-1)
+
+                # avoid repetition (as in greedy_search_batch): forbid the token that
+                # would make the last length + 1 tokens a copy of the ones before them
+                position = t + 1
+                for length in range(position):
+                    if position - 2 * length - 1 < 0:
+                        break
+                    repeated = (
+                        seqs[:, position - length : position]
+                        == seqs[:, position - 2 * length - 1 : position - length - 1]
+                    ).all(dim=1)
+                    rows = repeated.nonzero().squeeze(1)
+                    log_probs[rows, seqs[rows, position - length - 1]] = float("-inf")
+
+                # finished hypotheses are only extended with <pad>, at no cost
+                log_probs[finished] = float("-inf")
+                log_probs[finished, pad_token] = 0.0
+
+                candidate_scores = (scores.view(n_hyp, 1) + log_probs).view(batch_size, -1)
+                scores, top_k_indices = torch.topk(candidate_scores, beam_size, dim=1)
+                parents = (first_row + top_k_indices // vocab_size).view(-1)
+
+                seqs = seqs[parents]
+                seqs[:, t + 1] = (top_k_indices % vocab_size).view(-1)
+                s_i = s_i[parents]
+                alignments = alignments[parents]
+                alignments[:, t] = a_i.float().masked_fill(finished.unsqueeze(1), 0)[parents]
+
+            best = first_row.squeeze(1) + scores.argmax(dim=1)
+            # drop <sos> and the last token, and the first alignment
+            output = seqs[best, 1:-1]
+            alignments = alignments[best, 1:]
 
         return output, alignments
 
-    
-
     def plot_attention(
         self, source, prediction, allignments, titles, val=True, path=None
     ):
@@ -409,14 +597,20 @@ class AlignAndTranslate(nn.Module):
             else None,
         )
 
-    def eval(self, dataloader, max_len):
+    def eval(self, dataloader, max_len, inference_model=None):
         # try sentences of length till Tx
         bleu_scores = torch.zeros(max_len, len(dataloader))
         original_sentences = []
         predicted_sentences = []
         for _, val_sample in enumerate(dataloader):
             x, y = val_sample["english"]["idx"], val_sample["french"]["idx"]
-            output, _ = self.forward(x.to(self.device))
+            lengths = val_sample["english"]["lengths"]
+            if inference_model is None:
+                with torch.autocast(DEVICE, dtype=AMP_DTYPE):
+                    output, _ = self.forward(x.to(self.device), lengths)
+            else:
+                with torch.no_grad():
+                    output, _ = inference_model(x.to(self.device).long(), lengths)
             prediction_idx = torch.argmax(output, dim=-1)
             for length in range(1, max_len):
                 translation = self.sample_translation(
@@ -430,6 +624,41 @@ class AlignAndTranslate(nn.Module):
         )
         return torch.mean(bleu_scores, dim=1)
 
+    def export_onnx(self, path, batch_size: int = 1) -> None:
+        """
+        Exports the forward pass (encoder and Ty decoder steps) to ONNX in
+        float32, with a dynamic batch size, and checks the exported model.
+
+        Args:
+            path (str): Path of the ONNX file.
+            batch_size (int): Batch size of the example input used for tracing.
+        """
+        dummy_input = torch.zeros((batch_size, self.Tx), dtype=torch.long, device=self.device)
+        dummy_lengths = torch.full((batch_size,), self.Tx, dtype=torch.long)
+        # the captured CUDA graphs cannot be traced
+        cuda_graph, self.cuda_graph = self.cuda_graph, False
+        try:
+            with torch.no_grad():
+                torch.onnx.export(
+                    InferenceModel(self, autocast=False),
+                    (dummy_input, dummy_lengths),
+                    path,
+                    opset_version=17,
+                    input_names=["x", "lengths"],
+                    output_names=["output", "alignments"],
+                    dynamic_axes={
+                        "x": {0: "batch"},
+                        "lengths": {0: "batch"},
+                        "output": {0: "batch"},
+                        "alignments": {0: "batch"},
+                    },
+                    dynamo=False,
+                )
+        finally:
+            self.cuda_graph = cuda_graph
+        onnx.checker.check_model(path, full_check=True)
+        print(f"Model exported to {path}")
+
     def translate_sentence(self, sentences: List[Dict[Any, Any]]):
         tokenizer_en = MosesTokenizer(lang="en")
         tokenizer_fr = MosesTokenizer(lang="fr")
@@ -451,21 +680,26 @@ class AlignAndTranslate(nn.Module):
             idx_tensor_fr,
             self.Tx,
             self.Ty,
-            len(self.source_vocab),
-            len(self.target_vocab),
+            len(self.source_vocab) + 2,
+            len(self.target_vocab) + 2,
             False,
         )
+        # <pad> is the last index of the source vocabulary, as in load_data
+        lengths = idx_tensor_en.ne(len(self.source_vocab) + 1).sum(dim=1)
 
-        output, alignment = self.forward(idx_tensor_en.to(self.device))
+        with torch.no_grad(), torch.autocast(DEVICE, dtype=AMP_DTYPE):
+            # the encoder runs once, its states are shared by both decoders
+            encoded = self.encode(idx_tensor_en.to(self.device), lengths)
+            output, alignment = self.decode(*encoded)
 
-        output[:, :, -2] = torch.min(
-            output
-        )  # set the <unk> token to the minimum value so that it is not selected
+            output[:, :, -2] = torch.min(
+                output
+            )  # set the <unk> token to the minimum value so that it is not selected
 
-        if self.beam_search_flag:
-            prediction_idx, _ = self.beam_search_decoder(idx_tensor_en)
-        else:
-            prediction_idx = self.greedy_search_batch(output)
+            if self.beam_search_flag:
+                prediction_idx, _ = self.beam_search_decoder(idx_tensor_en, encoded=encoded)
+            else:
+                prediction_idx = self.greedy_search_batch(output)
         sample = self.sample_translation(idx_tensor_en, prediction_idx, idx_tensor_fr)
 
         return sample, alignment
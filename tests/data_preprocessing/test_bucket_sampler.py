@@ -0,0 +1,48 @@
+import unittest
+
+import torch
+
+from data_preprocessing.prep_data import BucketSampler
+
+
+class TestBucketSampler(unittest.TestCase):
+    def setUp(self):
+        self.lengths = torch.randint(1, 30, (103,))
+        self.batch_size = 8
+
+    def test_batches_cover_dataset(self):
+        sampler = BucketSampler(self.lengths, self.batch_size, num_replicas=1, rank=0)
+        batches = list(sampler)
+        self.assertEqual(len(batches), len(sampler))
+        indices = sorted(i for batch in batches for i in batch)
+        self.assertEqual(indices, list(range(len(self.lengths))))
+
+    def test_batches_group_similar_lengths(self):
+        sampler = BucketSampler(
+            self.lengths, self.batch_size, shuffle=False, num_replicas=1, rank=0
+        )
+        previous_max = 0
+        for batch in sampler:
+            batch_lengths = self.lengths[batch]
+            self.assertGreaterEqual(batch_lengths.min().item(), previous_max)
+            previous_max = batch_lengths.max().item()
+
+    def test_epochs_are_reshuffled(self):
+        sampler = BucketSampler(self.lengths, self.batch_size, num_replicas=1, rank=0)
+        first_epoch = list(sampler)
+        sampler.set_epoch(1)
+        self.assertNotEqual(first_epoch, list(sampler))
+
+    def test_replicas_get_same_number_of_batches(self):
+        samplers = [
+            BucketSampler(self.lengths, self.batch_size, num_replicas=3, rank=rank)
+            for rank in range(3)
+        ]
+        batches = [list(sampler) for sampler in samplers]
+        self.assertTrue(all(len(b) == len(samplers[0]) for b in batches))
+        indices = [i for rank_batches in batches for batch in rank_batches for i in batch]
+        self.assertEqual(len(indices), len(set(indices)))
+
+
+if __name__ == "__main__":
+    unittest.main()
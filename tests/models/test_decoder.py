@@ -2,7 +2,8 @@ import unittest
 
 import torch
 
-from models.decoder import Decoder
+from global_variables import AMP_DTYPE
+from models.decoder import Decoder, DecoderGraphRunner
 
 
 class TestDecoder(unittest.TestCase):
@@ -74,6 +75,75 @@ class TestDecoder(unittest.TestCase):
         output, _,_ = decoder(0,self.sample_entry_h, h_emb=None, s_i = None, y_i = self.sample_y)
         self.assertEqual(output.squeeze().shape, torch.Size([3,  12]))
 
+    @torch.autocast("cpu")
+    def test_forward_beam(self):
+        # A beam of hypotheses sharing the encoder states must give the same
+        # result as tiling the encoder states for every hypothesis
+        decoder = Decoder(**self.config, traditional=False)
+        h = self.sample_entry_h[:1]
+        h_emb = decoder.alignment.nn_h(h)
+        s_i = torch.rand(3, self.hidden_size)
+
+        output, s_next, e = decoder(0, h, h_emb=h_emb, s_i=s_i, y_i=self.sample_y)
+        tiled_output, tiled_s_next, tiled_e = decoder(
+            0, h.repeat(3, 1, 1), h_emb=h_emb.repeat(3, 1, 1), s_i=s_i, y_i=self.sample_y
+        )
+        self.assertEqual(output.shape, torch.Size([3, 12]))
+        self.assertEqual(e.shape, torch.Size([3, self.seqlen]))
+        self.assertTrue(torch.allclose(output.float(), tiled_output.float(), atol=1e-2))
+        self.assertTrue(torch.allclose(s_next.float(), tiled_s_next.float(), atol=1e-2))
+        self.assertTrue(torch.allclose(e, tiled_e, atol=1e-3))
+
+    @torch.autocast("cpu")
+    def test_forward_mask(self):
+        # Padded source positions must not receive any attention
+        decoder = Decoder(**self.config, traditional=False)
+        h_emb = decoder.alignment.nn_h(self.sample_entry_h)
+        lengths = torch.tensor([5, 2, 3])
+        src_mask = torch.arange(self.seqlen).unsqueeze(0) < lengths.unsqueeze(1)
+        output, _, e = decoder(
+            0, self.sample_entry_h, h_emb=h_emb, s_i=None, y_i=self.sample_y, src_mask=src_mask
+        )
+        self.assertEqual(output.shape, torch.Size([3, 12]))
+        self.assertEqual(e[~src_mask].abs().sum().item(), 0)
+        self.assertTrue(torch.allclose(e.sum(dim=1), torch.ones(3)))
+
+    @torch.autocast("cpu")
+    def test_forward_start_token(self):
+        # Without y_i the decoder starts from the one-hot start token buffer,
+        # which is not saved in the state dict
+        decoder = Decoder(**self.config, traditional=False)
+        h_emb = decoder.alignment.nn_h(self.sample_entry_h)
+        start = torch.zeros(3, self.vocab_size)
+        start[:, -2] = 1
+        output, _, _ = decoder(0, self.sample_entry_h, h_emb=h_emb)
+        explicit_output, _, _ = decoder(0, self.sample_entry_h, h_emb=h_emb, y_i=start)
+        self.assertTrue(torch.equal(output, explicit_output))
+        self.assertNotIn("start_token", decoder.state_dict())
+
+    @unittest.skipUnless(torch.cuda.is_available(), "CUDA graphs need a GPU")
+    def test_graph_runner_matches_eager(self):
+        # Replaying the captured step with new states and on a new encoder
+        # batch gives the results of the eager decoder
+        self.config["rnn"]["device"] = "cuda"
+        decoder = Decoder(**self.config, traditional=False).cuda()
+        runner = DecoderGraphRunner(decoder)
+        with torch.no_grad(), torch.autocast("cuda", dtype=AMP_DTYPE):
+            for batch in range(2):
+                h = torch.rand(3, self.seqlen, self.hidden_size * 2, device="cuda")
+                h_emb = decoder.alignment.nn_h(h)
+                lengths = torch.randint(1, self.seqlen + 1, (3,), device="cuda")
+                src_mask = torch.arange(self.seqlen, device="cuda").unsqueeze(0) < lengths.unsqueeze(1)
+                for t in range(3):
+                    s_i = torch.rand(3, self.hidden_size, device="cuda")
+                    y_i = torch.rand(3, self.vocab_size, device="cuda")
+                    if runner.graph is None:
+                        runner.capture(h, h_emb, s_i, y_i, src_mask)
+                    expected = decoder(t, h, h_emb, s_i, y_i, src_mask)
+                    replayed = runner(h, h_emb, s_i, y_i, src_mask)
+                    for e, r in zip(expected, replayed):
+                        self.assertTrue(torch.allclose(e.float(), r.float(), atol=1e-3))
+
 
 if __name__ == "__main__":
     unittest.main()
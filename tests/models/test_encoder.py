@@ -33,6 +33,30 @@ class TestEncoder(unittest.TestCase):
             rnn_hidden.shape, (2 * encoder.rnn.num_layers, batch_size, 10)
         )  # (2 * num_layers, batch_size, hidden_size)
 
+    def test_compiled_forward(self):
+        # The compiled encoder computes the same outputs as the eager one
+        config = dict(
+            rnn_hidden_size=10,
+            rnn_num_layers=1,
+            rnn_device="cpu",
+            vocab_size=20,
+            rnn_type="LSTM",
+            embedding_size=10,
+        )
+        torch.manual_seed(0)
+        encoder = Encoder(**config)
+        torch.manual_seed(0)
+        compiled_encoder = Encoder(**config, compile=True)
+
+        input_data = torch.randint(0, 20, (4, 5))
+        lengths = torch.tensor([5, 2, 3, 1])
+        with torch.no_grad():
+            for args in [(), (lengths,)]:
+                rnn_output, rnn_hidden = encoder(input_data, *args)
+                compiled_output, compiled_hidden = compiled_encoder(input_data, *args)
+                self.assertTrue(torch.allclose(rnn_output, compiled_output, atol=1e-5))
+                self.assertTrue(torch.allclose(rnn_hidden, compiled_hidden, atol=1e-5))
+
 
 if __name__ == "__main__":
     unittest.main()
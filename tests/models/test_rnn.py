@@ -3,7 +3,7 @@ import unittest
 import torch
 from torch import nn
 
-from models.rnn import RNN
+from models.rnn import RNN, JitLSTM
 
 
 class TestRNN(unittest.TestCase):
@@ -144,6 +144,159 @@ class TestRNN(unittest.TestCase):
         self.assertEqual(self.model.rnn.dropout, self.dropout)
         self.forward_pass()
 
+    def test_model_initialization_JitLSTM(self):
+        self.type = "JitLSTM"
+        # Create an instance of the RNN model
+        self.model = RNN(
+            self.input_size,
+            self.hidden_size,
+            self.num_layers,
+            self.device,
+            self.dropout,
+            type=self.type,
+        ).to(self.device)
+
+        # Check if the RNN layer is created with the correct parameters
+        self.assertIsInstance(self.model.rnn, JitLSTM)
+        self.assertEqual(self.model.rnn.input_size, self.input_size)
+        self.assertEqual(self.model.rnn.hidden_size, self.hidden_size)
+        self.assertEqual(self.model.rnn.num_layers, self.num_layers)
+        self.assertTrue(self.model.rnn.batch_first)
+        self.assertEqual(self.model.rnn.dropout, self.dropout)
+        self.forward_pass()
+
+    def test_JitLSTM_matches_LSTM(self):
+        # The scripted LSTM must compute the same function as torch.nn.LSTM
+        lstm = nn.LSTM(
+            self.input_size,
+            self.hidden_size,
+            self.num_layers,
+            batch_first=True,
+            bidirectional=True,
+        )
+        jit_lstm = JitLSTM(
+            self.input_size,
+            self.hidden_size,
+            self.num_layers,
+            bidirectional=True,
+        )
+        for layer in range(self.num_layers):
+            for direction, suffix in enumerate(["", "_reverse"]):
+                cell = jit_lstm.layers[layer * 2 + direction].cell
+                for name in ["weight_ih", "weight_hh", "bias_ih", "bias_hh"]:
+                    getattr(cell, name).data.copy_(
+                        getattr(lstm, f"{name}_l{layer}{suffix}").data
+                    )
+
+        x = torch.randn(4, 5, self.input_size)
+        h0 = torch.randn(self.num_layers * 2, 4, self.hidden_size)
+        c0 = torch.randn(self.num_layers * 2, 4, self.hidden_size)
+        out, (hidden, cell) = lstm(x, (h0, c0))
+        jit_out, (jit_hidden, jit_cell) = jit_lstm(x, (h0, c0))
+        self.assertTrue(torch.allclose(out, jit_out, atol=1e-5))
+        self.assertTrue(torch.allclose(hidden, jit_hidden, atol=1e-5))
+        self.assertTrue(torch.allclose(cell, jit_cell, atol=1e-5))
+
+    def test_LSTM_forward_matches_single_call(self):
+        # RNN.forward must run the LSTM exactly once with zero initial states
+        self.model = RNN(
+            self.input_size,
+            self.hidden_size,
+            self.num_layers,
+            "cpu",
+            0,
+            type="LSTM",
+        )
+        input_tensor = torch.randn(4, 5, self.input_size, requires_grad=True)
+        output_tensor, hidden_tensor = self.model(input_tensor)
+
+        zeros = torch.zeros(self.num_layers, 4, self.hidden_size)
+        expected_output, (expected_hidden, _) = self.model.rnn(
+            input_tensor, (zeros, zeros)
+        )
+        self.assertTrue(torch.equal(output_tensor, expected_output))
+        self.assertTrue(torch.equal(hidden_tensor, expected_hidden))
+
+        output_tensor.sum().backward()
+        self.assertIsNotNone(input_tensor.grad)
+
+    def test_zero_state_is_cached(self):
+        self.model = RNN(
+            self.input_size,
+            self.hidden_size,
+            self.num_layers,
+            "cpu",
+            0,
+            type="LSTM",
+        )
+        input_tensor = torch.randn(4, 5, self.input_size)
+        first_output, _ = self.model(input_tensor)
+        second_output, _ = self.model(input_tensor)
+        self.assertEqual(len(self.model._h0_cache), 1)
+        self.assertEqual(len(self.model._c0_cache), 1)
+        self.assertTrue(torch.equal(first_output, second_output))
+        self.assertEqual(self.model._h0_cache[(4, torch.float32)].abs().sum().item(), 0)
+
+        # Both steps must still be differentiable when sharing the cached states
+        (first_output.sum() + second_output.sum()).backward()
+
+    def test_packed_forward(self):
+        # Padded timesteps are skipped: the outputs match running the
+        # unpadded sequence alone and are zero on the padding
+        self.model = RNN(
+            self.input_size,
+            self.hidden_size,
+            self.num_layers,
+            "cpu",
+            0,
+            bidirectional=True,
+            type="LSTM",
+        )
+        input_tensor = torch.randn(3, 5, self.input_size)
+        lengths = torch.tensor([5, 2, 3])
+        output_tensor, hidden_tensor = self.model(input_tensor, lengths=lengths)
+        self.assertEqual(output_tensor.shape, torch.Size([3, 5, 2 * self.hidden_size]))
+
+        single_output, single_hidden = self.model(input_tensor[1:2, :2])
+        self.assertTrue(torch.allclose(output_tensor[1:2, :2], single_output, atol=1e-6))
+        self.assertTrue(torch.allclose(hidden_tensor[:, 1:2], single_hidden, atol=1e-6))
+        self.assertEqual(output_tensor[1, 2:].abs().sum().item(), 0)
+
+    def test_JitLSTM_rejects_lengths(self):
+        self.model = RNN(
+            self.input_size,
+            self.hidden_size,
+            self.num_layers,
+            "cpu",
+            0,
+            bidirectional=True,
+            type="JitLSTM",
+        )
+        input_tensor = torch.randn(3, 5, self.input_size)
+        with self.assertRaises(ValueError):
+            self.model(input_tensor, lengths=torch.tensor([5, 2, 3]))
+
+    def test_orthogonal_init(self):
+        self.model = RNN(
+            self.input_size,
+            self.hidden_size,
+            self.num_layers,
+            "cpu",
+            0,
+            type="LSTM",
+        )
+        for name, param in self.model.named_parameters():
+            if "weight" in name:
+                # (4 * hidden_size, n) matrices have orthonormal columns
+                gram = param.data.t() @ param.data
+                self.assertTrue(torch.allclose(gram, torch.eye(param.size(1)), atol=1e-5))
+            else:
+                self.assertEqual(param.data.abs().sum().item(), 0)
+        # Parameters of the same shape are not filled with the same matrix
+        self.assertFalse(
+            torch.equal(self.model.rnn.weight_hh_l0, self.model.rnn.weight_hh_l1)
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
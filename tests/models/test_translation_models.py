@@ -0,0 +1,157 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+from global_variables import AMP_DTYPE, DEVICE
+from models.translation_models import AlignAndTranslate, InferenceModel
+
+
+class TestAlignAndTranslate(unittest.TestCase):
+    def setUp(self) -> None:
+        self.hidden_size = 8
+        self.embedding_size = 6
+        self.vocab_size = 12
+        self.Tx = 5
+        self.Ty = 6
+
+        # The model creates its run folders in the working directory
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+
+        words = np.array([f"w{i}" for i in range(self.vocab_size - 2)])
+        config_encoder = dict(
+            rnn_hidden_size=self.hidden_size,
+            rnn_num_layers=1,
+            rnn_device="cpu",
+            vocab_size=self.vocab_size,
+            rnn_type="LSTM",
+            embedding_size=self.embedding_size,
+        )
+        config_decoder = dict(
+            alignment=dict(input_size=self.hidden_size * 3, device="cpu"),
+            rnn=dict(
+                input_size=self.hidden_size * 2 + self.embedding_size,
+                hidden_size=self.hidden_size,
+                num_layers=1,
+                device="cpu",
+                type="LSTM",
+            ),
+            output_nn=dict(
+                embedding_size=self.embedding_size,
+                max_out_units=5,
+                hidden_size=self.hidden_size,
+                vocab_size=self.vocab_size,
+                device="cpu",
+            ),
+            embedding=dict(
+                embedding_size=self.embedding_size,
+                vocab_size=self.vocab_size,
+                device="cpu",
+            ),
+            Ty=self.Ty,
+        )
+        config_training = dict(
+            device="cpu",
+            english_vocab=words,
+            french_vocab=words,
+            Tx=self.Tx,
+            Ty=self.Ty,
+        )
+        torch.manual_seed(0)
+        self.model = AlignAndTranslate(
+            encoder=config_encoder, decoder=config_decoder, training=config_training
+        )
+        # Spread the outputs, the initial weights make every token almost equally likely
+        with torch.no_grad():
+            for param in self.model.parameters():
+                param.normal_(std=0.5)
+
+        self.x = torch.randint(0, self.vocab_size - 1, (4, self.Tx))
+        self.lengths = torch.tensor([5, 2, 4, 1])
+
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+        return super().tearDown()
+
+    def test_inference_model(self):
+        # The exported view of the model runs the same function as forward
+        with torch.no_grad():
+            with torch.autocast(DEVICE, dtype=AMP_DTYPE):
+                output, alignments = self.model(self.x, self.lengths)
+            inference_output, inference_alignments = InferenceModel(self.model)(
+                self.x, self.lengths
+            )
+        self.assertEqual(output.shape, torch.Size([4, self.Ty, self.vocab_size]))
+        self.assertTrue(torch.equal(output, inference_output))
+        self.assertTrue(torch.equal(alignments, inference_alignments))
+
+    @unittest.skipUnless(onnxruntime is not None, "onnxruntime is not installed")
+    def test_export_onnx(self):
+        # The exported float32 graph runs in onnxruntime, with any batch size
+        path = os.path.join(self.tmp_dir.name, "model.onnx")
+        self.model.export_onnx(path, batch_size=4)
+        session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        for batch_size in (4, 2):
+            x, lengths = self.x[:batch_size], self.lengths[:batch_size]
+            with torch.no_grad():
+                output, alignments = self.model(x, lengths)
+            onnx_output, onnx_alignments = session.run(
+                None, {"x": x.numpy(), "lengths": lengths.numpy()}
+            )
+            self.assertTrue(torch.allclose(torch.from_numpy(onnx_output), output, atol=1e-5))
+            self.assertTrue(
+                torch.allclose(torch.from_numpy(onnx_alignments), alignments, atol=1e-5)
+            )
+
+    def test_beam_search(self):
+        pad_token = self.vocab_size - 1
+        # Make <pad> likely enough to end some of the hypotheses early
+        with torch.no_grad():
+            self.model.decoder.output_nn.output_nn.fc[-1].bias[pad_token] += 1.0
+            output, alignments = self.model.beam_search_decoder(
+                self.x, beam_size=3, lengths=self.lengths
+            )
+        self.assertEqual(output.shape, torch.Size([4, self.Ty]))
+        self.assertEqual(alignments.shape, torch.Size([4, self.Ty, self.Tx]))
+        self.assertTrue((output[:, :-1] == pad_token).any())
+
+        # The batch is decoded as every sentence on its own
+        for b in range(len(self.x)):
+            with torch.no_grad():
+                single_output, single_alignments = self.model.beam_search_decoder(
+                    self.x[b : b + 1], beam_size=3, lengths=self.lengths[b : b + 1]
+                )
+            self.assertTrue(torch.equal(single_output[0], output[b]))
+            self.assertTrue(torch.allclose(single_alignments[0], alignments[b], atol=1e-5))
+
+        # No token is immediately repeated, apart from the padding
+        repeated = (output[:, 1:] == output[:, :-1]) & (output[:, 1:] != pad_token)
+        self.assertFalse(repeated.any())
+
+        # Only <pad> follows the first <pad> of a sequence
+        after_pad = (output == pad_token).long().cummax(dim=1).values.bool()
+        self.assertTrue((output[after_pad] == pad_token).all())
+
+    def test_beam_search_avoids_repetition(self):
+        # Even when the model favours a single token, it is never emitted twice in a row
+        with torch.no_grad():
+            self.model.decoder.output_nn.output_nn.fc[-1].bias[3] += 5.0
+            output, _ = self.model.beam_search_decoder(self.x, beam_size=3, lengths=self.lengths)
+        self.assertTrue((output == 3).any())
+        self.assertFalse((output[:, 1:] == output[:, :-1]).any())
+
+
+if __name__ == "__main__":
+    unittest.main()